@@ -5,11 +5,30 @@ Simple extension to track Modal GPU credits
 
 import os
 import json
-import subprocess
-import psutil  # NEW: Added for CPU/Memory detection
+import atexit
+import asyncio
+import functools
+import hashlib
+import threading
+import time
+from datetime import datetime
+import aiofiles
+import aiofiles.os
 from aiohttp import web
 import server
 
+# orjson is optional: use the stdlib encoder when it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# NVML is optional: fall back to nvidia-smi when it is missing or fails to init
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
 # Export web directory
 WEB_DIRECTORY = "./js"
 
@@ -18,117 +37,408 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILE = os.path.join(SCRIPT_DIR, "config.json")
 BALANCE_FILE = os.path.join(SCRIPT_DIR, "balance.json")
 
+# Parsed JSON files, keyed by path: {path: (mtime_ns, data, payload, etag)}
+# payload is the encoded file content, served as-is by the GET routes
+_CACHE = {}
+
+# Reads in progress, keyed by (path, mtime_ns), shared by concurrent callers
+_INFLIGHT = {}
+
+# Serializes save_json so overlapping saves don't share the same temp file
+_SAVE_LOCK = asyncio.Lock()
+
+# NVML GPU info rarely changes at runtime; re-detect hourly to pick up hot-plug
+GPU_CACHE_TTL = 3600
+_GPU_CACHE = None
+_GPU_CACHE_TIME = 0.0
+
+# Returned (never cached) while no detection method has produced a name
+_GPU_UNKNOWN = {"gpu_name": "Unknown", "success": False}
+
+# NVML is initialised on first GPU query, not at import (None = not tried yet)
+# init_nvml runs on worker threads, so guard it against concurrent first calls
+_nvml_ready = None
+_nvml_lock = threading.Lock()
+# monotonic time of the last failed NVML device query; skipped for GPU_CACHE_TTL
+_nvml_failed_time = None
+
+# Long-lived `nvidia-smi -l` process used when NVML is unavailable; its
+# latest line is the cache on that path. An exited watcher is restarted at
+# most once per GPU_CACHE_TTL so a missing nvidia-smi isn't retried per request
+GPU_WATCH_INTERVAL = 60
+_gpu_watcher = None
+_gpu_watcher_started = 0.0
+_gpu_proc = None
+_latest_gpu = None
+_latest_gpu_info = None
+_gpu_ready = asyncio.Event()
+
+# nvidia-smi prints its errors to stdout; never take one of these for a name
+_NVIDIA_SMI_ERRORS = (
+    "No devices were found",
+    "NVIDIA-SMI has failed",
+    "Failed to initialize NVML",
+    "Unable to determine",
+    "Unknown Error",
+    "[",  # e.g. "[GPU requires reset]", "[Unknown Error]"
+)
+# How long to wait after the first line to make sure nvidia-smi didn't exit
+GPU_WATCH_CONFIRM_DELAY = 1.0
+
+# Pre-encoded system info: (gpu_info, system_info, payload, etag)
+_SYSTEM_INFO_CACHE = None
+
+
+def json_dumps(data):
+    """Encode data as compact JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def json_loads(payload):
+    """Decode JSON from bytes or str"""
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+
+def make_etag(payload):
+    """Return a strong ETag for an encoded response body"""
+    return '"%s"' % hashlib.blake2b(payload, digest_size=8).hexdigest()
+
+
+async def load_json_entry(path):
+    """Load a JSON file as (mtime_ns, data, payload, etag), re-reading only when its mtime changes"""
+    try:
+        st = await aiofiles.os.stat(path)
+    except FileNotFoundError:
+        _CACHE.pop(path, None)
+        return None
+
+    entry = _CACHE.get(path)
+    if entry and entry[0] == st.st_mtime_ns:
+        return entry
+
+    # Single-flight: concurrent misses for the same file share one read
+    key = (path, st.st_mtime_ns)
+    task = _INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_read_json_entry(path, st.st_mtime_ns))
+        _INFLIGHT[key] = task
+        task.add_done_callback(lambda _: _INFLIGHT.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def _read_json_entry(path, mtime_ns):
+    """Read and parse a JSON file into the cache"""
+    try:
+        async with aiofiles.open(path, 'rb') as f:
+            payload = await f.read()
+    except FileNotFoundError:
+        _CACHE.pop(path, None)
+        return None
+    entry = (mtime_ns, json_loads(payload), payload, make_etag(payload))
+    _CACHE[path] = entry
+    return entry
+
+
+async def load_json(path):
+    """Load a JSON file (cached)"""
+    entry = await load_json_entry(path)
+    return entry[1] if entry else None
+
+
+def _fsync_and_stat(fd):
+    """Flush a file descriptor to disk and return its stat result"""
+    os.fsync(fd)
+    return os.fstat(fd)
+
+
+async def save_json(path, data):
+    """Atomically save a JSON file and write it through to the cache"""
+    payload = json_dumps(data)
+    tmp_path = path + '.tmp'
+    async with _SAVE_LOCK:
+        try:
+            async with aiofiles.open(tmp_path, 'wb') as f:
+                await f.write(payload)
+                await f.flush()
+                # rename keeps the inode's mtime, so fstat the open fd instead of
+                # resolving the path again after the replace
+                st = await asyncio.to_thread(_fsync_and_stat, f.fileno())
+            await aiofiles.os.replace(tmp_path, path)
+        except BaseException:
+            # Don't leave a half-written temp file behind
+            try:
+                await aiofiles.os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        _CACHE[path] = (st.st_mtime_ns, data, payload, make_etag(payload))
+
+
+def json_payload_response(payload, status=200):
+    """Return already-encoded JSON bytes without re-serializing"""
+    return web.Response(body=payload, status=status, content_type='application/json')
 
-def load_config():
+
+def cached_json_response(request, payload, etag):
+    """Return encoded JSON with an ETag, or 304 if the client already has it"""
+    if request.headers.get('If-None-Match') == etag:
+        return web.Response(status=304, headers={'ETag': etag})
+    response = json_payload_response(payload)
+    response.headers['ETag'] = etag
+    return response
+
+
+def json_response(data, status=200):
+    """Encode data and return it as a JSON response"""
+    return json_payload_response(json_dumps(data), status=status)
+
+
+async def load_config():
     """Load configuration file"""
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r') as f:
-            return json.load(f)
-    return None
+    return await load_json(CONFIG_FILE)
 
 
-def load_balance():
+async def load_balance():
     """Load balance file"""
-    if os.path.exists(BALANCE_FILE):
-        with open(BALANCE_FILE, 'r') as f:
-            return json.load(f)
-    return None
+    return await load_json(BALANCE_FILE)
 
 
-def save_balance(balance_data):
+async def save_balance(balance_data):
     """Save balance to file"""
-    with open(BALANCE_FILE, 'w') as f:
-        json.dump(balance_data, f, indent=2)
+    await save_json(BALANCE_FILE, balance_data)
+
 
+def init_nvml():
+    """Initialise NVML on first use; returns True when it is usable"""
+    global _nvml_ready
+    if _nvml_ready is None:
+        with _nvml_lock:
+            if _nvml_ready is None:
+                ready = False
+                if pynvml is not None:
+                    try:
+                        pynvml.nvmlInit()
+                        atexit.register(pynvml.nvmlShutdown)
+                        ready = True
+                    except Exception as e:
+                        print(f"NVML init failed: {e}")
+                _nvml_ready = ready
+    return _nvml_ready
 
-def get_gpu_info():
-    """Detect GPU using nvidia-smi + CPU/Memory using psutil"""
-    result = {"gpu_name": "Unknown", "success": False}
-    
-    # Detect GPU (existing code)
+
+async def _watch_gpu():
+    """Read GPU names from a persistent nvidia-smi loop into _latest_gpu"""
+    global _gpu_proc, _latest_gpu
     try:
-        gpu_result = subprocess.run(
-            ['nvidia-smi', '--query-gpu=name', '--format=csv,noheader'],
-            capture_output=True,
-            text=True,
-            timeout=5
+        _gpu_proc = await asyncio.create_subprocess_exec(
+            'nvidia-smi', '-i', '0', '-l', str(GPU_WATCH_INTERVAL),
+            '--query-gpu=name', '--format=csv,noheader,nounits',
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
         )
-        if gpu_result.returncode == 0:
-            result["gpu_name"] = gpu_result.stdout.strip()
-            result["success"] = True
+        confirmed = False
+        while True:
+            line = await _gpu_proc.stdout.readline()
+            if not line:
+                break
+            gpu_name = line.decode('ascii', 'replace').strip()
+            if not gpu_name or gpu_name.startswith(_NVIDIA_SMI_ERRORS):
+                continue
+            if not confirmed:
+                # A healthy `-l` loop keeps running; one that exits straight
+                # after printing has failed, whatever it printed
+                try:
+                    await asyncio.wait_for(_gpu_proc.wait(), GPU_WATCH_CONFIRM_DELAY)
+                    break
+                except asyncio.TimeoutError:
+                    confirmed = True
+            _latest_gpu = gpu_name
+            _gpu_ready.set()
+        if await _gpu_proc.wait() != 0:
+            _latest_gpu = None
     except Exception as e:
+        _latest_gpu = None
         print(f"GPU detection failed: {e}")
-    
-    # NEW: Detect CPU and Memory (added to same function)
+    finally:
+        # Wake up waiters even if nvidia-smi never produced a line
+        _gpu_ready.set()
+
+
+def _stop_gpu_watcher():
+    """Terminate the nvidia-smi loop on shutdown"""
+    if _gpu_proc is not None and _gpu_proc.returncode is None:
+        try:
+            _gpu_proc.terminate()
+        except ProcessLookupError:
+            pass
+
+
+atexit.register(_stop_gpu_watcher)
+
+
+async def get_watched_gpu_name(timeout=5):
+    """Return the latest nvidia-smi GPU name, starting the watcher if needed"""
+    global _gpu_watcher, _gpu_watcher_started
+    now = time.monotonic()
+    if _gpu_watcher is None or (
+            _gpu_watcher.done() and now - _gpu_watcher_started >= GPU_CACHE_TTL):
+        _gpu_ready.clear()
+        _gpu_watcher_started = now
+        _gpu_watcher = asyncio.create_task(_watch_gpu())
+    try:
+        await asyncio.wait_for(_gpu_ready.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    return _latest_gpu
+
+
+def get_nvml_gpu_name():
+    """Return the name of GPU 0 via NVML, or None (blocking)"""
+    if not init_nvml():
+        return None
     try:
-        cpu_result = subprocess.run(['nproc'], capture_output=True, text=True, timeout=5)
-        if cpu_result.returncode == 0:
-            result["cpu_cores"] = int(cpu_result.stdout.strip())
-        else:
-            result["cpu_cores"] = 0
-        result["memory_total_gb"] = 0   # Will use config value instead
+        handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+        gpu_name = pynvml.nvmlDeviceGetName(handle)
+        if isinstance(gpu_name, bytes):
+            gpu_name = gpu_name.decode()
+        return gpu_name
+    except Exception as e:
+        print(f"NVML GPU detection failed: {e}")
+        return None
+
+
+async def get_gpu_info():
+    """Detect GPU using NVML/nvidia-smi (cached)"""
+    global _GPU_CACHE, _GPU_CACHE_TIME, _latest_gpu_info, _nvml_failed_time
+    now = time.monotonic()
+    if _GPU_CACHE is not None and now - _GPU_CACHE_TIME < GPU_CACHE_TTL:
+        return _GPU_CACHE
+
+    # Detect GPU via NVML (in-process, no fork) on a worker thread, unless it
+    # is unavailable or its device query failed recently
+    nvml_failed_recently = (_nvml_failed_time is not None
+                            and now - _nvml_failed_time < GPU_CACHE_TTL)
+    if _nvml_ready is not False and not nvml_failed_recently:
+        gpu_name = await asyncio.to_thread(get_nvml_gpu_name)
+        if gpu_name:
+            _nvml_failed_time = None
+            _GPU_CACHE = {"gpu_name": gpu_name, "success": True}
+            _GPU_CACHE_TIME = now
+            return _GPU_CACHE
+        _nvml_failed_time = now
+
+    # Fall back to the persistent nvidia-smi loop, which keeps its own value
+    # fresh; reuse the dict while the name is unchanged
+    gpu_name = await get_watched_gpu_name()
+    if not gpu_name:
+        return _GPU_UNKNOWN
+    if _latest_gpu_info is None or _latest_gpu_info["gpu_name"] != gpu_name:
+        _latest_gpu_info = {"gpu_name": gpu_name, "success": True}
+    return _latest_gpu_info
+
+
+@functools.lru_cache(maxsize=1)
+def get_compute_resources():
+    """Detect usable CPU cores and total memory (constant per boot)"""
+    result = {"cpu_cores": 0, "memory_total_gb": 0}
+    # Count the CPUs this process may run on (like nproc), so cpuset-limited
+    # containers don't report every host core
+    try:
+        result["cpu_cores"] = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        pass
+    try:
+        import psutil  # Imported lazily to keep ComfyUI startup fast
+        if not result["cpu_cores"]:
+            result["cpu_cores"] = psutil.cpu_count(logical=True) or 0
+        result["memory_total_gb"] = round(psutil.virtual_memory().total / (1024 ** 3), 2)
     except Exception as e:
         print(f"CPU detection failed: {e}")
-        result["cpu_cores"] = 0
-        result["memory_total_gb"] = 0
-    
     return result
 
 
+async def get_system_info_entry():
+    """Combine GPU and CPU/Memory information as (system_info, payload, etag)"""
+    global _SYSTEM_INFO_CACHE
+    gpu_info = await get_gpu_info()
+    if _SYSTEM_INFO_CACHE is None or _SYSTEM_INFO_CACHE[0] is not gpu_info:
+        compute_resources = await asyncio.to_thread(get_compute_resources)
+        system_info = {**gpu_info, **compute_resources}
+        payload = json_dumps(system_info)
+        _SYSTEM_INFO_CACHE = (gpu_info, system_info, payload, make_etag(payload))
+    return _SYSTEM_INFO_CACHE[1:]
+
+
+def push_balance(balance_data):
+    """Push a server-side balance change to all connected clients"""
+    server.PromptServer.instance.send_sync("credit_tracker.balance", balance_data)
+
+
 # API Routes
 @server.PromptServer.instance.routes.get("/credit_tracker/config")
 async def get_config(request):
     """Get configuration"""
-    config = load_config()
-    if config:
-        return web.json_response(config)
-    return web.json_response({"error": "Config not found"}, status=404)
+    entry = await load_json_entry(CONFIG_FILE)
+    if entry and entry[1]:
+        return cached_json_response(request, entry[2], entry[3])
+    return json_response({"error": "Config not found"}, status=404)
 
 
 @server.PromptServer.instance.routes.get("/credit_tracker/balance")
 async def get_balance(request):
     """Get current balance"""
-    balance = load_balance()
-    if balance:
-        return web.json_response(balance)
-    return web.json_response({"error": "Balance not found"}, status=404)
+    entry = await load_json_entry(BALANCE_FILE)
+    if entry and entry[1]:
+        return json_payload_response(entry[2])
+    return json_response({"error": "Balance not found"}, status=404)
 
 
 @server.PromptServer.instance.routes.post("/credit_tracker/balance")
 async def update_balance(request):
     """Save balance"""
     try:
-        balance_data = await request.json()
-        save_balance(balance_data)
-        return web.json_response({"success": True})
+        balance_data = json_loads(await request.read())
+        await save_balance(balance_data)
+        return json_response({"success": True})
     except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
+        return json_response({"error": str(e)}, status=500)
+
+
+@server.PromptServer.instance.routes.get("/credit_tracker/system_info")
+async def get_system(request):
+    """Get GPU, CPU and memory information"""
+    _, payload, etag = await get_system_info_entry()
+    return cached_json_response(request, payload, etag)
 
 
 @server.PromptServer.instance.routes.get("/credit_tracker/gpu_info")
 async def get_gpu(request):
-    """Get GPU information"""
-    gpu_info = get_gpu_info()
-    return web.json_response(gpu_info)
+    """Get GPU information (kept for compatibility, same as system_info)"""
+    return await get_system(request)
 
 
 @server.PromptServer.instance.routes.post("/credit_tracker/reset")
 async def reset_balance(request):
     """Reset balance to starting amount"""
     try:
-        config = load_config()
+        config = await load_config()
         if not config:
-            return web.json_response({"error": "Config not found"}, status=404)
+            return json_response({"error": "Config not found"}, status=404)
         
-        from datetime import datetime
         balance_data = {
             "last_updated": datetime.now().isoformat(),
             "remaining_balance": config.get("starting_balance", 80.0)
         }
-        save_balance(balance_data)
-        return web.json_response({"success": True, "balance": balance_data})
+        await save_balance(balance_data)
+        if config.get("push_balance_updates", True):
+            push_balance(balance_data)
+        return json_response({"success": True, "balance": balance_data})
     except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
+        return json_response({"error": str(e)}, status=500)
 
 
 print("✅ Credit Tracker: Extension loaded")
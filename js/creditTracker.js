@@ -26,6 +26,7 @@ class CreditTracker {
         this.gpuCount = 1;
         this.costPerSecond = 0;
         this.lastUpdate = Date.now();
+        this.lastSave = this.lastUpdate;
         this.displayElement = null;
         this.sliderElement = null;      // The animated color bar
         this.containerElement = null;   // The main container
@@ -39,6 +40,17 @@ class CreditTracker {
         await this.detectGPU();
         this.createDisplay();
         this.startTracking();
+        this.listenForUpdates();
+    }
+
+    listenForUpdates() {
+        // Server pushes balance changes (e.g. /credit_tracker/reset) over the
+        // ComfyUI websocket, so the next save doesn't overwrite them
+        api.addEventListener('credit_tracker.balance', (event) => {
+            this.balance = event.detail;
+            this.updateDisplay();
+            console.log('✅ Credit Tracker: Balance updated by server');
+        });
     }
 
     async loadConfig() {
@@ -91,19 +103,13 @@ class CreditTracker {
 
     async detectGPU() {
         try {
-            const response = await api.fetchApi('/credit_tracker/gpu_info');
+            const response = await api.fetchApi('/credit_tracker/system_info');
             if (response.ok) {
                 const gpuInfo = await response.json();
                 this.gpuType = gpuInfo.gpu_name;
                 this.gpuCount = this.config.gpu_count;
                 
-                let costPerHour = 1.0;
-                for (const [gpuName, cost] of Object.entries(this.config.gpu_costs_per_hour)) {
-                    if (this.gpuType.includes(gpuName) || gpuName.includes(this.gpuType)) {
-                        costPerHour = cost;
-                        break;
-                    }
-                }
+                const costPerHour = this.lookupGpuCost(this.gpuType);
                 
                 this.costPerSecond = (costPerHour / 3600) * this.gpuCount;
                 console.log(✅ Credit Tracker: GPU detected - ${this.gpuType} @ $${costPerHour}/hr);
@@ -115,6 +121,22 @@ class CreditTracker {
         }
     }
 
+    lookupGpuCost(gpuType) {
+        // Exact name match first, then the longest configured name contained
+        // in the detected one (so "NVIDIA L40S" wins over "NVIDIA L4")
+        const costs = this.config.gpu_costs_per_hour;
+        if (Object.prototype.hasOwnProperty.call(costs, gpuType)) {
+            return costs[gpuType];
+        }
+        const gpuNames = Object.keys(costs).sort((a, b) => b.length - a.length);
+        for (const gpuName of gpuNames) {
+            if (gpuType.includes(gpuName) || gpuName.includes(gpuType)) {
+                return costs[gpuName];
+            }
+        }
+        return 1.0;
+    }
+
     // ╔═══════════════════════════════════════════════════════════════════════╗
     // ║ CHANGE #1: COMPLETELY REWRITTEN createDisplay() FUNCTION             ║
     // ║ Added animated color bar with container and slider structure         ║
@@ -277,20 +299,23 @@ class CreditTracker {
     startTracking() {
         // Update credits every second
         setInterval(() => {
+            // Modal bills wall-clock time (including while this machine sleeps),
+            // so use Date.now(); clamp to absorb backward clock steps
             const now = Date.now();
-            const elapsed = (now - this.lastUpdate) / 1000;
+            const elapsed = Math.max(0, now - this.lastUpdate) / 1000;
             
             // Deduct credits based on GPU cost
-            const cost = this.costPerSecond * elapsed;
-            this.balance.remaining_balance = Math.max(0, this.balance.remaining_balance - cost);
-            this.balance.last_updated = new Date().toISOString();
+            const balance = this.balance;
+            balance.remaining_balance = Math.max(0, balance.remaining_balance - this.costPerSecond * elapsed);
             
             // Update the display
             this.updateDisplay();
             
-            // Save to file every 10 seconds
-            if (Math.floor(now / 1000) % 10 === 0) {
+            // Save to file every 10 seconds (wall-clock timestamp only when persisted)
+            if (now - this.lastSave >= 10000) {
+                balance.last_updated = new Date().toISOString();
                 this.saveBalance();
+                this.lastSave = now;
             }
             
             this.lastUpdate = now;